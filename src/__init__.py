@@ -1,7 +1,7 @@
 import re
-import time
 import base64
-from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from queue import Queue
 from urllib.parse import urlparse, unquote, urlencode, quote, parse_qs
 from urllib.request import Request, urlopen
 
@@ -10,7 +10,13 @@ from calibre.ebooks.metadata.sources.base import Source
 from calibre.ebooks.chardet import xml_to_unicode
 from calibre.utils.cleantext import clean_ascii_chars
 from lxml import etree
-from lxml.html import tostring
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    # Not every calibre build ships requests, fall back to calibre's browser
+    requests = None
 
 # note that string passed-in will need to be url-encoded
 QIDIAN_SEARCH_URL = "https://www.qidian.com/so/%s.html"
@@ -28,20 +34,87 @@ QIDIAN_BOOKCOVER_URL = 'https://bookcover.yuewen.com/qdbimg/349573/%s'
 BING_SEARCH_BASE_URL = 'https://www.bing.com/search'
 # XPath for Bing search results
 BING_SEARCH_RESULTS_XPATH = '//ol[@id="b_results"]/li[@class="b_algo"]//h2/a'
+# XPath for Qidian mobile search results
+QIDIAN_SEARCH_RESULTS_XPATH = '//div[contains(@class, "searchResList")]//div[contains(@class, "list__item")]/a[contains(@class, "listItem")]'
+
+# XPath expressions are compiled once here and reused for every lookup
+_XP_SEARCH_RESULTS = etree.XPath(QIDIAN_SEARCH_RESULTS_XPATH)
+_XP_METAS = etree.XPath('//meta[@property or @name]')
+
+# og:* meta tags read from a book page, parsing stops once all of them are found
+BOOK_META_KEYS = frozenset([
+    'og:novel:book_name', 'og:novel:author', 'og:description',
+    'og:novel:category', 'og:novel:status'
+])
 
 PROVIDER_ID = "qidian"
 PROVIDER_VERSION = (1, 4, 1)
 PROVIDER_AUTHOR = 'Otaro'
 
+# Low ASCII control characters removed by clean_ascii_chars
+_needs_clean = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]').search
+
 def parse_html(raw):
     try:
         from html5_parser import parse
     except ImportError:
         # Old versions of calibre
         import html5lib
+        if isinstance(raw, bytes):
+            raw = xml_to_unicode(raw, strip_encoding_pats=True, resolve_entities=True)[0]
+            if _needs_clean(raw):
+                raw = clean_ascii_chars(raw)
         return html5lib.parse(raw, treebuilder='lxml', namespaceHTMLElements=False)
     else:
-        return parse(raw)
+        # html5-parser sniffs the encoding of bytes input itself
+        return parse(raw, maybe_xhtml=False)
+
+class _MetasDone(Exception):
+    pass
+
+def _add_meta(metas, attrib):
+    key = attrib.get('property') or attrib.get('name')
+    content = (attrib.get('content') or '').strip()
+    if key and content:
+        metas.setdefault(key, content)
+
+def book_title_author(metas):
+    return metas.get('og:novel:book_name') or metas.get('og:title'), metas.get('og:novel:author')
+
+class _MetaCollector(object):
+    """lxml parser target mapping <meta> property or name to its first non-empty content"""
+
+    def __init__(self, wanted):
+        self.metas = {}
+        self.wanted = wanted
+
+    def start(self, tag, attrib):
+        if tag == 'meta':
+            _add_meta(self.metas, attrib)
+            # everything we need has been seen, skip parsing the rest of the page
+            if self.wanted.issubset(self.metas):
+                raise _MetasDone()
+
+    def close(self):
+        return self.metas
+
+def parse_book_metas(raw):
+    # decode up front, libxml2 only honours a <meta charset> that comes before the og tags
+    text = xml_to_unicode(raw, strip_encoding_pats=True, assume_utf8=True)[0]
+    collector = _MetaCollector(BOOK_META_KEYS)
+    parser = etree.HTMLParser(target=collector)
+    try:
+        parser.feed(text)
+        parser.close()
+    except _MetasDone:
+        pass
+    metas = collector.metas
+    if not all(book_title_author(metas)):
+        # libxml2 recovers from broken markup differently, retry on the html5 tree
+        metas = {}
+        for meta in _XP_METAS(parse_html(raw)):
+            _add_meta(metas, meta.attrib)
+    return metas
 
 # a metadata download plugin
 class Qidian(Source):
@@ -62,26 +135,37 @@ class Qidian(Source):
 
     def __init__(self, *args, **kwargs):
         Source.__init__(self, *args, **kwargs)
+        self._headers = {
+            'User-Agent': 'Mozilla/5.0 (Linux; Android 13; Pixel 6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Mobile Safari/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+        }
+        self._session = self._create_session()
+
+    def _create_session(self):
+        """Keep-alive session shared by all requests to qidian, yuewen and bing"""
+        if requests is None:
+            return None
+        session = requests.Session()
+        session.headers.update(self._headers)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount('https://', adapter)
+        return session
 
     def _get_browser(self):
         br = self.browser
-        try:
-            headers = dict(getattr(br, 'addheaders', []))
-        except Exception:
-            headers = {}
-        headers['User-Agent'] = 'Mozilla/5.0 (Linux; Android 13; Pixel 6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Mobile Safari/537.36'
-        headers.setdefault('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8')
-        headers.setdefault('Accept-Language', 'zh-CN,zh;q=0.9,en;q=0.8')
-        br.addheaders = list(headers.items())
+        # calibre's browser only sets a User-agent by default, which ours replaces;
+        # every clone gets its own list so it can't change the shared headers
+        br.addheaders = list(self._headers.items())
         return br
 
-    def _first_text(self, values, default=None):
-        for v in values:
-            if v:
-                v = v.strip()
-                if v:
-                    return v
-        return default
+    def _open(self, url, timeout=30):
+        """Fetch url and return the response body as bytes"""
+        if self._session is not None:
+            res = self._session.get(url, timeout=timeout)
+            res.raise_for_status()
+            return res.content
+        return self._get_browser().open_novisit(url, timeout=timeout).read()
 
     def get_book_url(self, identifiers):
         qidian_id = identifiers.get(PROVIDER_ID, None)
@@ -99,10 +183,8 @@ class Qidian(Source):
         return None
     
     def id_from_url(self, url):
-        res = QIDIAN_BOOK_URL_PATTERN.findall(url)
-        if len(res) == 1:
-            return res[0]
-        return None
+        m = QIDIAN_BOOK_URL_PATTERN.search(url)
+        return m.group(1) if m else None
         
     # def extract_real_url_from_ck(self, href, log):
     #     """
@@ -216,8 +298,8 @@ class Qidian(Source):
     #         log.exception(f'Error searching Bing: {e}')
     #         return []
 
-    def search_qidian(self, title, author, log, timeout=30):
-        """Search Qidian Mobile for books based on title and author"""
+    def search_qidian(self, title, author, log, timeout=30, max_results=3):
+        """Search Qidian Mobile for books based on title and author, returns at most max_results books"""
         # Build search terms
         search_terms = []
         
@@ -237,27 +319,26 @@ class Qidian(Source):
         log.info(f'Searching Qidian with query: {combined}')
         log.info(f'Search URL: {search_url}')
         
-        br = self._get_browser()
         try:
-            raw = br.open_novisit(search_url, timeout=timeout).read().strip()
-            raw = clean_ascii_chars(xml_to_unicode(raw, strip_encoding_pats=True, resolve_entities=True)[0])
+            raw = self._open(search_url, timeout=timeout).strip()
             
             root = parse_html(raw)
             
             # Use the specific XPath for Qidian search results
-            search_results = root.xpath('//div[contains(@class, "searchResList")]//div[contains(@class, "list__item")]/a[contains(@class, "listItem")]', method='html', encoding='utf-8')
+            search_results = _XP_SEARCH_RESULTS(root)
             
             log.info(f'Found {len(search_results)} search results from Qidian')
             
             # Process results to find valid Qidian book pages
             found_ids = []
+            seen_ids = set()
             
             for result in search_results:
                 # link returned here is chapter link
                 href = result.get('href', '')
 
                 # Extract all text from the element, including text in <strong> tags
-                result_text = "".join(result.xpath('.//text()', method='html', encoding='utf-8')).strip()
+                result_text = etree.tostring(result, method='text', encoding='unicode', with_tail=False).strip()
                 
                 log.info(f'Examining search result: "{result_text}" -> {href}')
                 
@@ -268,9 +349,12 @@ class Qidian(Source):
                 # Extract book ID from URL
                 qidian_id = self.id_from_url(href)
                 
-                if qidian_id:
+                if qidian_id and qidian_id not in seen_ids:
                     log.info(f'Found book ID: {qidian_id} from URL: {href}')
+                    seen_ids.add(qidian_id)
                     found_ids.append((qidian_id, href, result_text))
+                    if len(found_ids) >= max_results:
+                        break
             
             return found_ids
             
@@ -278,6 +362,74 @@ class Qidian(Source):
             log.exception(f'Error searching Bing: {e}')
             return []
 
+    def _fetch_book_metas(self, url, timeout=30):
+        return parse_book_metas(self._open(url, timeout=timeout).strip())
+
+    def _first_book_metas(self, urls, log, timeout=30):
+        """
+        Fetch and parse urls concurrently, returns (url, metas) of the first page that
+        has title and author meta tags, or (None, None) if none has.
+        Requests already running can't be cancelled, the slower ones finish (or time out)
+        in a background thread and hold their pooled connection until then.
+        """
+        executor = ThreadPoolExecutor(max_workers=len(urls))
+        futures = {}
+        try:
+            for url in urls:
+                futures[executor.submit(self._fetch_book_metas, url, timeout)] = url
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    metas = future.result()
+                except Exception as e:
+                    log.exception(e)
+                    continue
+                # anti-bot and interstitial pages answer 200 without the og tags
+                if all(book_title_author(metas)):
+                    return url, metas
+                log.info('No title/author meta tags found in: %s' % url)
+            return None, None
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _fetch_book_by_id(self, qidian_id, log, timeout=30):
+        """Fetch book details for a single qidian id, returns Metadata or None"""
+        # mobile and desktop pages carry the same og:* meta tags, use whichever is usable first
+        urls = (M_QIDIAN_BOOK_URL % qidian_id, QIDIAN_BOOK_URL_OLD % qidian_id)
+        log.info('identify with qidian id (%s) from urls: %s' % (qidian_id, ', '.join(urls)))
+        url, metas = self._first_book_metas(urls, log, timeout)
+        if metas is None:
+            url = QIDIAN_BOOK_URL % qidian_id
+            log.info('Trying fallback URL: %s' % url)
+            url, metas = self._first_book_metas((url,), log, timeout)
+        if metas is None:
+            log.error('Failed to extract title/author from Qidian pages for id %s' % qidian_id)
+            return None
+        log.info('Reading book details from: %s' % url)
+
+        title, author = book_title_author(metas)
+        desc = metas.get('og:description') or metas.get('description')
+        category = metas.get('og:novel:category')
+        status = metas.get('og:novel:status')
+        tags = []
+        if category:
+            tags.append(category)
+        if status:
+            tags.append(status)
+
+        mi = Metadata(title, [author])
+        mi.identifiers = { PROVIDER_ID: qidian_id }
+        mi.comments = desc
+        mi.publisher = "起点中文网"
+        mi.language = 'zh_CN'
+        mi.tags = tags
+        mi.url = QIDIAN_BOOK_URL % qidian_id
+        mi.cover = QIDIAN_BOOKCOVER_URL % qidian_id
+
+        return mi
+
     def identify(
             self,
             log,
@@ -290,70 +442,9 @@ class Qidian(Source):
 
         qidian_id = identifiers.get(PROVIDER_ID, None)
         if qidian_id:
-            url = M_QIDIAN_BOOK_URL % qidian_id
-            log.info('identify with qidian id (%s) from mobile url: %s' % (qidian_id, url))
-            br = self._get_browser()
-            try:
-                raw = br.open_novisit(url, timeout=timeout).read().strip()
-            except Exception as e:
-                log.exception(e)
-                for url_tpl in (QIDIAN_BOOK_URL_OLD, QIDIAN_BOOK_URL):
-                    try:
-                        url = url_tpl % qidian_id
-                        log.info('Trying fallback URL: %s' % url)
-                        raw = br.open_novisit(url, timeout=timeout).read().strip()
-                        break
-                    except Exception as e2:
-                        log.exception(e2)
-                else:
-                    return None
-
-            raw = clean_ascii_chars(xml_to_unicode(raw, strip_encoding_pats=True, resolve_entities=True)[0])
-
-            try:
-                root = parse_html(raw)
-            except Exception as e:
-                log.exception(e)
-                return None
-
-            title = self._first_text(
-                root.xpath('//meta[@property="og:novel:book_name"]/@content') +
-                root.xpath('//meta[@property="og:title"]/@content')
-            )
-            author = self._first_text(
-                root.xpath('//meta[@property="og:novel:author"]/@content')
-            )
-            desc = self._first_text(
-                root.xpath('//meta[@property="og:description"]/@content') +
-                root.xpath('//meta[@name="description"]/@content')
-            )
-            category = self._first_text(
-                root.xpath('//meta[@property="og:novel:category"]/@content')
-            )
-            status = self._first_text(
-                root.xpath('//meta[@property="og:novel:status"]/@content')
-            )
-            tags = []
-            if category:
-                tags.append(category)
-            if status:
-                tags.append(status)
-
-            if not title or not author:
-                log.error('Failed to extract title/author from Qidian mobile page for id %s' % qidian_id)
-                return None
-
-            mi = Metadata(title, [author])
-            mi.identifiers = { PROVIDER_ID: qidian_id }
-            mi.comments = desc
-            mi.publisher = "起点中文网"
-            mi.language = 'zh_CN'
-            mi.tags = tags
-            mi.url = QIDIAN_BOOK_URL % qidian_id
-            mi.cover = QIDIAN_BOOKCOVER_URL % qidian_id
-
-            result_queue.put(mi)
-
+            mi = self._fetch_book_by_id(qidian_id, log, timeout)
+            if mi:
+                result_queue.put(mi)
             return None
         
         # If we have other identifiers, give up
@@ -390,44 +481,53 @@ class Qidian(Source):
             
         log.info(f'Found {len(search_results)} potential books')
         
-        # Process each found book ID (limit to first 3)
-        for i, (book_id, book_url, result_text) in enumerate(search_results[:3]):
-            if abort.is_set():
-                break
-                
-            log.info(f'Processing book {i+1} with ID {book_id}')
-            
-            # Fetch book details using the existing identify method
-            book_identifiers = {PROVIDER_ID: book_id}
-            
-            # Create a temporary queue to get results from the identify call
-            temp_queue = Queue()
-            
-            # Recursively call identify with the found ID
-            self.identify(log, temp_queue, abort, identifiers=book_identifiers, timeout=timeout)
-            
-            # Check if we got a result
-            results = []
-            while True:
-                try:
-                    results.append(temp_queue.get_nowait())
-                except Empty:
-                    break
-            
-            for mi in results:
-                # Verify title/author if they were provided
-                book_title = mi.title.lower() if mi.title else ''
-                book_authors = [a.lower() for a in mi.authors] if mi.authors else []
-                
-                # Basic verification logic
-                title_match = title.lower() in book_title or book_title in title.lower()
-                author_match = not author or any(author.lower() in ba or ba in author.lower() for ba in book_authors)
-                
-                if title_match and author_match:
-                    log.info(f'Found matching book: {mi.title} by {", ".join(mi.authors)}')
-                    result_queue.put(mi)
-                else:
-                    log.info(f'Skipping non-matching book: {mi.title} by {", ".join(mi.authors)}')
+        # Fetch details of the first 3 found book IDs concurrently
+        candidates = search_results[:3]
+        books = [None] * len(candidates)
+        executor = ThreadPoolExecutor(max_workers=3)
+        futures = {}
+        try:
+            for i, (book_id, book_url, result_text) in enumerate(candidates):
+                log.info(f'Processing book {i+1} with ID {book_id}')
+                futures[executor.submit(self._fetch_book_by_id, book_id, log, timeout)] = i
+            pending = set(futures)
+            while pending:
+                # wake up regularly so an abort does not wait for the slowest fetch
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        books[futures[future]] = future.result()
+                    except Exception as e:
+                        log.exception(e)
+                if abort.is_set():
+                    return None
+        finally:
+            # fetches still running after an abort finish in the background
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        title_lc = title.lower()
+        author_lc = author.lower() if author else None
+
+        # Verify in search result order so relevance is preserved
+        for mi in books:
+            if mi is None:
+                continue
+
+            # Verify title/author if they were provided
+            book_title_lc = (mi.title or '').lower()
+            book_authors_lc = [a.lower() for a in (mi.authors or [])]
+
+            # Basic verification logic
+            title_match = title_lc in book_title_lc or book_title_lc in title_lc
+            author_match = not author_lc or any(author_lc in ba or ba in author_lc for ba in book_authors_lc)
+
+            if title_match and author_match:
+                log.info(f'Found matching book: {mi.title} by {", ".join(mi.authors)}')
+                result_queue.put(mi)
+            else:
+                log.info(f'Skipping non-matching book: {mi.title} by {", ".join(mi.authors)}')
         
         return None
 
@@ -457,12 +557,7 @@ class Qidian(Source):
             if abort.is_set():
                 return
 
-            results = []
-            while True:
-                try:
-                    results.append(rq.get_nowait())
-                except Empty:
-                    break
+            results = list(rq.queue)
 
             if len(results) == 0:
                 log.info('no result after running identify')
@@ -481,28 +576,24 @@ class Qidian(Source):
             log.info('No id found after running identify')
             return
 
-        cover_url = QIDIAN_BOOKCOVER_URL % qidian_id
-        br = self._get_browser()
-        log('Downloading latest cover from:', cover_url)
-        try:
-            time.sleep(1)
-            cdata = br.open_novisit(cover_url, timeout=timeout).read()
-            if cdata:
-                result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download latest cover from:', cover_url)
-
         # @TODO: implement a comparison method for get_best_cover
-        old_cover_url = QIDIAN_BOOKCOVER_URL_OLD % qidian_id
-        br = self._get_browser()
-        log('Downloading old cover from:', old_cover_url)
-        try:
-            time.sleep(1)
-            cdata = br.open_novisit(old_cover_url, timeout=timeout).read()
-            if cdata:
-                result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download old cover from:', old_cover_url)
+        covers = (
+            ('latest', QIDIAN_BOOKCOVER_URL % qidian_id),
+            ('old', QIDIAN_BOOKCOVER_URL_OLD % qidian_id),
+        )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = []
+            for name, cover_url in covers:
+                log('Downloading %s cover from:' % name, cover_url)
+                futures.append(executor.submit(self._open, cover_url, timeout))
+            # both downloads run concurrently, queue them latest first
+            for (name, cover_url), future in zip(covers, futures):
+                try:
+                    cdata = future.result()
+                    if cdata:
+                        result_queue.put((self, cdata))
+                except:
+                    log.exception('Failed to download %s cover from:' % name, cover_url)
 
 
 if __name__ == "__main__":